@@ -1,17 +1,32 @@
-from fastapi import FastAPI, HTTPException
-import requests
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 import os
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, ValidationError, constr
+from typing import Optional, Dict, List, Literal
+from cachetools import TTLCache
+import redis.asyncio as redis
+import asyncio
+import hashlib
 import httpx
+import itertools
 import logging
+import logging.handlers
+import orjson
+import queue
+import time
 import uuid
+import uvicorn
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging, records are written by a background thread so the event loop never blocks on stderr
+log_queue: queue.Queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Enable CORS
 app.add_middleware(
@@ -22,99 +37,319 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger responses (generated code) for clients that accept gzip
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # OpenAI API Configuration
 OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_HEADERS = {
+    "Authorization": f"Bearer {OPENAI_API_KEY}",
+    "Content-Type": "application/json"
+}
+OPENAI_MODEL = "gpt-4-turbo"
+
+# System prompts
+SYS_EXPLAIN = {"role": "system", "content": "Explain this error in simple terms:"}
+SYS_TRANSLATE = {
+    "role": "system",
+    "content": "You are a code translator. Convert the following code to the target language. No comments or explanations."
+}
+SYS_DEBUG = {"role": "system", "content": "You are an AI code optimizer. Fix syntax errors and improve efficiency."}
+SYS_SEARCH = {"role": "system", "content": "Provide only valid and executable code in response, without any explanation."}
 
 # Judge0 API Configuration (Compiler)
 JUDGE0_API_URL = "https://judge0-ce.p.rapidapi.com/submissions"
 JUDGE0_HEADERS = {
-    "x-rapidapi-key": "301672c4bamsh972d06a1d1de8bap1b473ajsn0dcda6e5ef99",
     "x-rapidapi-host": "judge0-ce.p.rapidapi.com",
     "Content-Type": "application/json"
 }
+# Comma-separated RapidAPI keys, used round-robin to spread the per-key rate limit
+JUDGE0_KEYS = [key.strip() for key in os.getenv("JUDGE0_KEYS", "").split(",") if key.strip()]
+JUDGE0_KEY_HEADERS = {key: {**JUDGE0_HEADERS, "x-rapidapi-key": key} for key in JUDGE0_KEYS}
+JUDGE0_KEY_COOLDOWN = 60.0
+JUDGE0_SUBMIT_URL = f"{JUDGE0_API_URL}?base64_encoded=false&wait=false"
+JUDGE0_POLL_TIMEOUT = 30.0
+# Each poll is a billed RapidAPI call, so the first one waits for a typical run to finish
+JUDGE0_FIRST_POLL_DELAY = 1.0
+JUDGE0_MAX_POLL_INTERVAL = 2.0
+INPUT_PROMPT_TAIL = 256
+
+# Redis Configuration (optional, shares executions across workers)
+REDIS_URL = os.getenv("REDIS_URL")
+EXECUTION_TTL = 900
+SWEEP_INTERVAL = 60
+
+# Shared HTTP clients
+@app.on_event("startup")
+async def startup():
+    log_listener.start()
+    app.state.redis = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+    app.state.judge0_client = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=40),
+        http2=True
+    )
+    app.state.openai_client = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        http2=True,
+        headers=OPENAI_HEADERS
+    )
+    app.state.sweeper_stop = asyncio.Event()
+    app.state.sweeper = asyncio.create_task(sweep_expired_entries(app.state.sweeper_stop))
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.sweeper_stop.set()
+    await app.state.sweeper
+    await app.state.judge0_client.aclose()
+    await app.state.openai_client.aclose()
+    if app.state.redis:
+        await app.state.redis.aclose()
+    log_listener.stop()
+
+# In-memory execution store, used when Redis is not configured
+executions: TTLCache = TTLCache(maxsize=10_000, ttl=EXECUTION_TTL)
+executions_lock = asyncio.Lock()
+
+async def get_execution(execution_id: str) -> Optional[Dict]:
+    if app.state.redis:
+        execution = await app.state.redis.hgetall(f"exec:{execution_id}")
+        return execution or None
+    async with executions_lock:
+        return executions.get(execution_id)
+
+async def save_execution(execution_id: str, execution: Dict):
+    if app.state.redis:
+        key = f"exec:{execution_id}"
+        async with app.state.redis.pipeline(transaction=True) as pipe:
+            mapping = {field: value or "" for field, value in execution.items()}
+            await pipe.hset(key, mapping=mapping).expire(key, EXECUTION_TTL).execute()
+        return
+    async with executions_lock:
+        executions[execution_id] = execution
+
+# Periodically drop expired entries so stale sessions don't wait for the next access to be evicted
+async def sweep_expired_entries(stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=SWEEP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        async with executions_lock:
+            executions.expire()
+        openai_cache.expire()
 
-# In-memory execution store
-executions: Dict[str, Dict] = {}
+# OpenAI response cache, keyed by a hash of the full payload
+openai_cache: TTLCache = TTLCache(maxsize=2048, ttl=3600)
+openai_inflight: Dict[str, asyncio.Task] = {}
+
+# Request Models, sizes are capped before anything is sent upstream
+MAX_SOURCE_CODE_LENGTH = 100_000
+MAX_STDIN_LENGTH = 10_000
+MAX_TEXT_LENGTH = 100_000
+MAX_LANGUAGE_LENGTH = 64
+MAX_BATCH_TASKS = 10
+
+SourceCode = constr(max_length=MAX_SOURCE_CODE_LENGTH)
+Stdin = constr(max_length=MAX_STDIN_LENGTH)
+LongText = constr(max_length=MAX_TEXT_LENGTH)
+LanguageName = constr(max_length=MAX_LANGUAGE_LENGTH)
 
-# Request Models
 class CodeRequest(BaseModel):
     language_id: int
-    source_code: Optional[str] = None
-    stdin: Optional[str] = None
+    source_code: Optional[SourceCode] = None
+    stdin: Optional[Stdin] = None
     execution_id: Optional[str] = None
 
 class ErrorExplainRequest(BaseModel):
-    error_message: str
+    error_message: LongText
 
 class TranslateRequest(BaseModel):
-    source_code: str
-    target_language: str
+    source_code: SourceCode
+    target_language: LanguageName
 
 class DebugRequest(BaseModel):
-    source_code: str
+    source_code: SourceCode
 
 class SearchRequest(BaseModel):
-    query: str
+    query: LongText
+
+class AITask(BaseModel):
+    type: Literal["explain", "translate", "debug", "search"]
+    payload: Dict
+
+class AIBatchRequest(BaseModel):
+    tasks: List[AITask] = Field(max_length=MAX_BATCH_TASKS)
+
+class AnalyzeRequest(BaseModel):
+    source_code: SourceCode
+    error_message: Optional[LongText] = None
+    target_language: Optional[LanguageName] = None
 
 # OpenAI API Call
 async def make_openai_request(payload: dict):
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    key = hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    if key in openai_cache:
+        return openai_cache[key]
+
+    # Single-flight: concurrent identical payloads share one upstream task. Every caller waits
+    # through shield, so cancelling one caller never cancels the request for the others
+    task = openai_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(post_openai(payload))
+        task.add_done_callback(lambda done: finish_openai_request(key, done))
+        openai_inflight[key] = task
+    return await asyncio.shield(task)
+
+def finish_openai_request(key: str, task: asyncio.Task):
+    openai_inflight.pop(key, None)
+    # Checking exception() also marks a failure as retrieved when every caller has gone
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if "error" not in result:
+        openai_cache[key] = result
+
+async def post_openai(payload: dict):
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(OPENAI_API_URL, json=payload, headers=headers)
-            response.raise_for_status()
-            return response.json()
+        response = await app.state.openai_client.post(OPENAI_API_URL, content=orjson.dumps(payload))
+        response.raise_for_status()
+        return orjson.loads(response.content)
     except httpx.HTTPStatusError as e:
-        logging.error(f"OpenAI API request failed: {e}")
+        logging.error("OpenAI API request failed: %s", e)
         return {"error": "OpenAI API request failed"}
     except httpx.ReadTimeout:
         logging.error("OpenAI API request timed out")
         return {"error": "OpenAI API request timed out"}
 
+# Streamed OpenAI API Call, forwards the SSE chunks as they arrive
+async def stream_openai_request(payload: dict):
+    client = app.state.openai_client
+    try:
+        response = await client.send(
+            client.build_request("POST", OPENAI_API_URL, content=orjson.dumps({**payload, "stream": True})),
+            stream=True
+        )
+    except httpx.ReadTimeout:
+        logging.error("OpenAI API request timed out")
+        raise HTTPException(status_code=500, detail="OpenAI API request timed out")
+
+    if response.is_error:
+        await response.aclose()
+        logging.error("OpenAI API request failed: %s", response.status_code)
+        raise HTTPException(status_code=500, detail="OpenAI API request failed")
+
+    async def forward():
+        async for line in response.aiter_lines():
+            if line:
+                yield line + "\n\n"
+
+    return StreamingResponse(forward(), media_type="text/event-stream", background=BackgroundTask(response.aclose))
+
 # Health Check
 @app.get("/")
 def read_root():
     return {"message": "Compiler API is running"}
 
+# Judge0 key rotation, keys that hit a 429 are skipped until their cooldown ends
+judge0_key_cycle = itertools.cycle(JUDGE0_KEYS)
+judge0_key_cooldowns: Dict[str, float] = {}
+judge0_key_lock = asyncio.Lock()
+
+async def next_judge0_key() -> Optional[str]:
+    async with judge0_key_lock:
+        now = time.monotonic()
+        for _ in range(len(JUDGE0_KEYS)):
+            key = next(judge0_key_cycle)
+            if judge0_key_cooldowns.get(key, 0.0) <= now:
+                return key
+    return None
+
+async def judge0_request(method: str, url: str, **kwargs):
+    for _ in range(len(JUDGE0_KEYS)):
+        key = await next_judge0_key()
+        if key is None:
+            break
+        response = await app.state.judge0_client.request(method, url, headers=JUDGE0_KEY_HEADERS[key], **kwargs)
+        if response.status_code != 429:
+            response.raise_for_status()
+            return response
+        logging.warning("Judge0 key rate limited, cooling down")
+        judge0_key_cooldowns[key] = time.monotonic() + JUDGE0_KEY_COOLDOWN
+    raise HTTPException(status_code=503, detail="No Judge0 API key available")
+
+# Submit to Judge0 without waiting, then poll until the run finishes
+async def run_judge0_submission(submission: dict):
+    submission_response = await judge0_request("POST", JUDGE0_SUBMIT_URL, content=orjson.dumps(submission))
+    token = orjson.loads(submission_response.content)["token"]
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JUDGE0_POLL_TIMEOUT
+    backoff = JUDGE0_FIRST_POLL_DELAY
+    while True:
+        await asyncio.sleep(backoff)
+        result_response = await judge0_request("GET", f"{JUDGE0_API_URL}/{token}?base64_encoded=false")
+        result = orjson.loads(result_response.content)
+        # Status 1 is "In Queue" and 2 is "Processing", anything higher is final
+        if result.get("status", {}).get("id", 0) >= 3:
+            return result
+        if loop.time() >= deadline:
+            raise HTTPException(status_code=504, detail="Judge0 execution timed out")
+        backoff = min(backoff * 2, JUDGE0_MAX_POLL_INTERVAL)
+
+# Re-raise a model ValidationError as FastAPI's 422, with locations relative to the request body
+def body_validation_error(e: ValidationError, *loc) -> RequestValidationError:
+    return RequestValidationError(
+        [{**error, "loc": ("body", *loc, *error["loc"])} for error in e.errors(include_url=False, include_context=False)]
+    )
+
+# Parse and validate the raw body in one pass with pydantic-core's JSON parser
+async def parse_code_request(http_request: Request) -> CodeRequest:
+    try:
+        return CodeRequest.model_validate_json(await http_request.body())
+    except ValidationError as e:
+        raise body_validation_error(e)
+
 # Run code via Judge0
-@app.post("/run_code/")
-async def run_code(request: CodeRequest):
+@app.post(
+    "/run_code/",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": CodeRequest.model_json_schema()}},
+            "required": True
+        }
+    }
+)
+async def run_code(http_request: Request):
+    request = await parse_code_request(http_request)
     try:
-        if request.execution_id and request.execution_id in executions:
-            execution = executions[request.execution_id]
+        execution = await get_execution(request.execution_id) if request.execution_id else None
+        if execution:
             source_code = execution["source_code"]
             stdin = execution["stdin"] + "\n" + (request.stdin or "")
         else:
-            execution_id = str(uuid.uuid4())
             source_code = request.source_code
             stdin = request.stdin or ""
-            executions[execution_id] = {"source_code": source_code, "stdin": stdin}
-
-        submission_response = requests.post(
-            f"{JUDGE0_API_URL}?base64_encoded=false&wait=true",
-            json={
-                "source_code": source_code,
-                "language_id": request.language_id,
-                "stdin": stdin,
-                "cpu_time_limit": 10,
-                "memory_limit": 262144
-            },
-            headers=JUDGE0_HEADERS
-        )
-        submission_response.raise_for_status()
-        result = submission_response.json()
 
-        output = result.get("stdout", "")
+        result = await run_judge0_submission({
+            "source_code": source_code,
+            "language_id": request.language_id,
+            "stdin": stdin,
+            "cpu_time_limit": 10,
+            "memory_limit": 262144
+        })
+
+        output = result.get("stdout") or ""
         error = result.get("stderr", "") or result.get("compile_output", "")
 
-        requires_input = "input" in output.lower() or output.endswith(": ")
+        # Input prompts are printed last, so only the tail of stdout needs checking
+        tail = output[-INPUT_PROMPT_TAIL:]
+        requires_input = "input" in tail.lower() or tail.endswith(": ")
         if requires_input:
             execution_id = request.execution_id or str(uuid.uuid4())
-            executions[execution_id] = {"source_code": source_code, "stdin": stdin}
+            await save_execution(execution_id, {"source_code": source_code, "stdin": stdin})
         else:
             execution_id = None
 
@@ -125,37 +360,55 @@ async def run_code(request: CodeRequest):
             "execution_id": execution_id
         }
 
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Judge0 connection error: {str(e)}")
+    except httpx.HTTPError as e:
+        logging.error("Judge0 connection error: %s", e)
         raise HTTPException(status_code=502, detail=f"Judge0 connection error: {str(e)}")
 
-# Explain Errors
-@app.post("/explain_error/")
-async def explain_error(request: ErrorExplainRequest):
-    payload = {
-        "model": "gpt-4-turbo",
+# OpenAI payload builders, static system prompts go first so every request shares the same prefix
+def build_explain_payload(request: ErrorExplainRequest):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [SYS_EXPLAIN, {"role": "user", "content": request.error_message}]
+    }
+
+def build_translate_payload(request: TranslateRequest):
+    return {
+        "model": OPENAI_MODEL,
         "messages": [
-            {"role": "system", "content": "Explain this error in simple terms:"},
-            {"role": "user", "content": request.error_message}
+            SYS_TRANSLATE,
+            {"role": "system", "content": f"Target language: {request.target_language}"},
+            {"role": "user", "content": request.source_code}
         ]
     }
+
+def build_debug_payload(request: DebugRequest):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [SYS_DEBUG, {"role": "user", "content": request.source_code}]
+    }
+
+def build_search_payload(request: SearchRequest):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [SYS_SEARCH, {"role": "user", "content": request.query}]
+    }
+
+# Explain Errors
+@app.post("/explain_error/")
+async def explain_error(request: ErrorExplainRequest, stream: bool = False):
+    payload = build_explain_payload(request)
+    if stream:
+        return await stream_openai_request(payload)
     result = await make_openai_request(payload)
     return {"explanation": result["choices"][0]["message"]["content"]}
 
 # Translate Code
 @app.post("/translate_code/")
-async def translate_code(request: TranslateRequest):
-    logging.info(f"Received translation request: {request}")
-    payload = {
-        "model": "gpt-4-turbo",
-        "messages": [
-            {
-                "role": "system",
-                "content": f"You are a code translator. Convert the following code to {request.target_language}. No comments or explanations."
-            },
-            {"role": "user", "content": request.source_code}
-        ]
-    }
+async def translate_code(request: TranslateRequest, stream: bool = False):
+    logging.info("Received translation request: %s", request)
+    payload = build_translate_payload(request)
+    if stream:
+        return await stream_openai_request(payload)
     result = await make_openai_request(payload)
 
     if "error" in result:
@@ -165,14 +418,10 @@ async def translate_code(request: TranslateRequest):
 
 # Debug Code
 @app.post("/debug/")
-async def debug_code(request: DebugRequest):
-    payload = {
-        "model": "gpt-4-turbo",
-        "messages": [
-            {"role": "system", "content": "You are an AI code optimizer. Fix syntax errors and improve efficiency."},
-            {"role": "user", "content": request.source_code}
-        ]
-    }
+async def debug_code(request: DebugRequest, stream: bool = False):
+    payload = build_debug_payload(request)
+    if stream:
+        return await stream_openai_request(payload)
     result = await make_openai_request(payload)
 
     if "error" in result:
@@ -182,13 +431,86 @@ async def debug_code(request: DebugRequest):
 
 # ChatGPT Code Search
 @app.post("/chatgpt_search/")
-async def chatgpt_search(request: SearchRequest):
+async def chatgpt_search(request: SearchRequest, stream: bool = False):
+    payload = build_search_payload(request)
+    if stream:
+        return await stream_openai_request(payload)
+    result = await make_openai_request(payload)
+    return {"code": result.get("choices", [{}])[0].get("message", {}).get("content", "Error fetching code")}
+
+# Batch task type -> (request model, payload builder, response key)
+AI_TASKS = {
+    "explain": (ErrorExplainRequest, build_explain_payload, "explanation"),
+    "translate": (TranslateRequest, build_translate_payload, "translated_code"),
+    "debug": (DebugRequest, build_debug_payload, "optimized_code"),
+    "search": (SearchRequest, build_search_payload, "code"),
+}
+
+# Run several AI tasks concurrently
+@app.post("/ai_batch/")
+async def ai_batch(request: AIBatchRequest):
+    payloads = []
+    keys = []
+    for i, task in enumerate(request.tasks):
+        model, build_payload, key = AI_TASKS[task.type]
+        try:
+            payloads.append(build_payload(model.model_validate(task.payload)))
+        except ValidationError as e:
+            raise body_validation_error(e, "tasks", i, "payload")
+        keys.append(key)
+
+    results = await asyncio.gather(*[make_openai_request(payload) for payload in payloads])
+
+    return {
+        "results": [
+            {"error": result["error"]} if "error" in result
+            else {key: result["choices"][0]["message"]["content"]}
+            for key, result in zip(keys, results)
+        ]
+    }
+
+# Explain, debug and optionally translate in a single completion
+@app.post("/analyze/")
+async def analyze(request: AnalyzeRequest):
+    keys = ["optimized_code"]
+    instructions = ["\"optimized_code\": the code with syntax errors fixed and efficiency improved"]
+    if request.error_message:
+        keys.insert(0, "explanation")
+        instructions.insert(0, "\"explanation\": the error explained in simple terms")
+    if request.target_language:
+        keys.append("translated_code")
+        instructions.append(
+            f"\"translated_code\": the code converted to {request.target_language}, no comments or explanations"
+        )
+
+    user_content = request.source_code
+    if request.error_message:
+        user_content = f"Code:\n{request.source_code}\n\nError:\n{request.error_message}"
+
     payload = {
-        "model": "gpt-4-turbo",
+        "model": OPENAI_MODEL,
+        "response_format": {"type": "json_object"},
         "messages": [
-            {"role": "system", "content": "Provide only valid and executable code in response, without any explanation."},
-            {"role": "user", "content": request.query}
+            {
+                "role": "system",
+                "content": "You are an AI code assistant. Respond with a JSON object containing: "
+                + "; ".join(instructions) + "."
+            },
+            {"role": "user", "content": user_content}
         ]
     }
     result = await make_openai_request(payload)
-    return {"code": result.get("choices", [{}])[0].get("message", {}).get("content", "Error fetching code")}
+
+    if "error" in result:
+        raise HTTPException(status_code=500, detail=result["error"])
+
+    try:
+        analysis = orjson.loads(result["choices"][0]["message"]["content"])
+    except (KeyError, IndexError, ValueError):
+        raise HTTPException(status_code=502, detail="OpenAI returned an invalid analysis")
+
+    return {key: analysis.get(key, "") for key in keys}
+
+if __name__ == "__main__":
+    # "auto" picks uvloop and httptools when they are installed (not available on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop="auto", http="auto")